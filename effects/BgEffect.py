@@ -9,13 +9,15 @@ class BgEffect(Effect):
     MODE_IN_OUT = 2
     MODE_OUT_IN = 3
 
-    def __init__(self, width, height, duration, scale_factor=1, mode=MODE_IN, easing=None):
+    def __init__(self, width, height, duration, scale_factor=1, mode=MODE_IN, easing=None,
+                 prepared=False):
         self.width = width
         self.height = height
         self.duration = duration
         self.scale_factor = scale_factor
         self.mode = mode
         self.easing = easing
+        self.prepared = prepared
 
     def calc_factor(self, k):
         if self.easing is not None:
@@ -84,6 +86,9 @@ class BgEffect(Effect):
 
 
     def apply(self, clip: Clip):
-        return clip.image_transform(self.resize).transform(self.zoom)
+        if not self.prepared:
+            clip = clip.image_transform(self.resize)
+
+        return clip.transform(self.zoom)
 
 
@@ -1,28 +1,37 @@
 import argparse
 import hashlib
 import itertools
+import json
 import os
+import queue
 import random
 import re
 import datetime
 import subprocess
+import sys
+import threading
+import time
+import uuid
 
-from functools import cached_property
+from functools import cached_property, lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from typing import List
 
+import numpy as np
 import requests
-from PIL import ImageFont
+from PIL import Image, ImageDraw, ImageFont
 from dotenv import load_dotenv
 from markdown import Markdown
 from moviepy import *
+from proglog import ProgressBarLogger
 from urllib3.util.ssl_match_hostname import match_hostname
 
 from effects.AlphaEffect import AlphaEffect
 from effects.BgEffect import BgEffect
 
 parser = argparse.ArgumentParser(prog='Text2Video', description='This app converts text to video.')
-parser.add_argument("markdown_file")
+parser.add_argument("markdown_file", nargs="?")
 parser.add_argument("--width", required=False, default=1080, type=int)
 parser.add_argument("--height", required=False, default=1920, type=int)
 parser.add_argument("--fps", required=False, default=30, type=int)
@@ -34,14 +43,122 @@ parser.add_argument("--font-path", required=False, default="./assets/fonts")
 parser.add_argument("--font-name", required=False, default="roboto")
 parser.add_argument("--font-size", required=False, default=100, type=int)
 parser.add_argument("--text-padding", required=False, default=50, type=int)
-
-args = parser.parse_args()
+parser.add_argument("--serve", required=False, action="store_true")
+parser.add_argument("--host", required=False, default="127.0.0.1")
+parser.add_argument("--port", required=False, default=8000, type=int)
+parser.add_argument("--workers", required=False, default=2, type=int)
+parser.add_argument("--seed", required=False, default=None, type=int)
+parser.add_argument("--date", required=False, default=None, type=datetime.date.fromisoformat)
+parser.add_argument("--stub-audio", required=False, action="store_true")
+parser.add_argument("--golden-dir", required=False, default=None)
+parser.add_argument("--frames", required=False, default="1,5,15.5,17,30",
+                    type=lambda s: [float(t) for t in s.split(",")])
+parser.add_argument("--psnr", required=False, default=60.0, type=float)
+parser.add_argument("--update-golden", required=False, action="store_true")
+
+args = None
 
 FONT_HEIGHT = 0
 SPACE_WIDTH = 0
+clock = datetime.date.today
 IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
 SHORT_DELAY = 0.5
 AUDIO_MODEL = "jaxongir"
+LOGO_FILE = "./assets/itboom-uz-logo-white.png"
+STUB_AUDIO_FPS = 44100
+STUB_LETTER_TIME = 0.06
+TEXT_SPRITE_CACHE_SIZE = 4096
+CODE_PLACEHOLDER_FONT_SIZE = 40
+CODE_PLACEHOLDER_PADDING = 40
+GOLDEN_FILE_PATTERN = r"(\d{2})-(\d+\.\d{2})\.png"
+
+
+def configure(argv=None):
+    global args, FONT_HEIGHT
+
+    args = parser.parse_args(argv)
+
+    # the sprite caches are keyed by content only, sizes come from args
+    for sprite in (text_sprite, footer_sprite, logo_sprite, background_sprite):
+        sprite.cache_clear()
+
+    if args.markdown_file is None and not args.serve:
+        parser.error("markdown_file is required unless --serve is given")
+
+    if args.golden_dir is not None and (args.seed is None or args.date is None):
+        parser.error("--golden-dir requires --seed and --date")
+
+    if args.golden_dir is not None:
+        args.stub_audio = True
+
+    if args.date is not None:
+        set_clock(lambda: args.date)
+    else:
+        set_clock(datetime.date.today)
+
+    FONT_HEIGHT = ContentText.get_font_max_height()
+    # SPACE_WIDTH = TextClip(
+    #     text=" ",
+    #     font=ContentText.get_font_path(True, False, False),
+    #     font_size=args.font_size
+    # ).size[0]
+
+    return args
+
+
+def set_clock(new_clock):
+    global clock
+    clock = new_clock
+
+
+def today():
+    return clock()
+
+
+def choose_background(short, bg_files):
+    if args.seed is None:
+        return random.choice(bg_files)
+
+    # seeded per short, so the choice does not depend on render order
+    return random.Random(f"{args.seed}:{short.name}").choice(bg_files)
+
+
+@lru_cache(maxsize=TEXT_SPRITE_CACHE_SIZE)
+def text_sprite(text, font):
+    return TextClip(
+        text=text,
+        font=font,
+        font_size=args.font_size,
+        color="white",
+        stroke_color="#000000",
+        stroke_width=5,
+        margin=(10, 10)
+    )
+
+
+@lru_cache(maxsize=None)
+def footer_sprite(text):
+    return TextClip(
+        text=text,
+        text_align="center",
+        font=ContentText.get_font_path(True, False),
+        font_size=50,
+        color="black",
+        stroke_color="white",
+        stroke_width=3,
+        margin=(50, 50),
+    )
+
+
+@lru_cache(maxsize=None)
+def logo_sprite():
+    return ImageClip(img=LOGO_FILE)
+
+
+@lru_cache(maxsize=None)
+def background_sprite(bg_image):
+    return ImageClip(bg_image).image_transform(BgEffect(width=args.width, height=args.height, duration=0).resize)
+
 
 class ContentText:
     def __init__(self, text, is_bold=False, is_italic=False):
@@ -83,15 +200,7 @@ class ContentText:
     def clips(self):
         result = []
         for word in self.text.split():
-            clip = TextClip(
-                text=self.process_text(word, False),
-                font=self.font,
-                font_size=args.font_size,
-                color="white",
-                stroke_color="#000000",
-                stroke_width=5,
-                margin=(10, 10)
-            )
+            clip = text_sprite(self.process_text(word, False), self.font).copy()
             clip.ai_text = self.process_text(word, True)
             result.append(clip)
         return result
@@ -157,6 +266,12 @@ class ContentCode(ContentImage):
             alt.append("dastur kodi")
 
         source = "\n".join(lines)
+
+        # golden frames must not depend on carbon-now or on whatever is cached in ./code
+        if args.golden_dir is not None:
+            super().__init__(self.placeholder(source), "\n".join(alt))
+            return
+
         code_file_name = hashlib.md5(source.encode('utf-8')).hexdigest()
         code_file = os.path.join(args.code_directory, code_file_name + ".png")
         if not os.path.exists(code_file):
@@ -176,11 +291,19 @@ class ContentCode(ContentImage):
 
         super().__init__(code_file, "\n".join(alt))
 
+    @staticmethod
+    def placeholder(source):
+        font = ImageFont.truetype(ContentText.get_font_path(), size=CODE_PLACEHOLDER_FONT_SIZE)
+        _, _, width, height = ImageDraw.Draw(Image.new("RGB", (1, 1))).multiline_textbbox((0, 0), source, font=font)
+
+        image = Image.new("RGB", (width + 2 * CODE_PLACEHOLDER_PADDING, height + 2 * CODE_PLACEHOLDER_PADDING), "white")
+        ImageDraw.Draw(image).multiline_text(
+            (CODE_PLACEHOLDER_PADDING, CODE_PLACEHOLDER_PADDING), source, font=font, fill="black"
+        )
+        return np.array(image)
 
-class ContentPage:
-    WIDTH = args.width - 2 * args.text_padding
-    HEIGHT = args.height // 2
 
+class ContentPage:
     def __init__(self):
         self.is_image = False
         self.with_audio = True
@@ -189,6 +312,14 @@ class ContentPage:
         self.__line_width = 0
         self.__audio = None
 
+    @property
+    def WIDTH(self):
+        return args.width - 2 * args.text_padding
+
+    @property
+    def HEIGHT(self):
+        return args.height // 2
+
     @property
     def duration(self):
         return self.clips[0][0].duration + SHORT_DELAY
@@ -326,11 +457,15 @@ class Content:
 
 
 def parse_markdown(filename):
-    md = Markdown(extensions=["attr_list"])
-
     with open(filename, "r") as f:
         source = f.read()
 
+    return parse_markdown_source(source, os.path.dirname(filename))
+
+
+def parse_markdown_source(source, base_dir):
+    md = Markdown(extensions=["attr_list"])
+
     md.lines = source.split("\n")
     for prep in md.preprocessors:
         md.lines = prep.run(md.lines)
@@ -365,7 +500,7 @@ def parse_markdown(filename):
 
             if elm.tag == "img":
                 content.add_image(ContentImage(
-                    file=os.path.join(os.path.dirname(args.markdown_file), elm.attrib.get("src")),
+                    file=os.path.join(base_dir, elm.attrib.get("src")),
                     alt=elm.attrib.get("alt", "")
                 ))
 
@@ -409,52 +544,59 @@ def load_audio(short: ContentShort):
 
             text = " ".join(lines)
 
-        audio_file = os.path.join("./audio", AUDIO_MODEL + "-" + hashlib.md5(text.encode('utf-8')).hexdigest() + ".mp3")
-        if os.path.exists(audio_file):
-            page.audio = AudioFileClip(audio_file).with_start(offset)
+        if args.stub_audio:
+            page.audio = stub_audio(text).with_start(offset)
             offset += page.audio.duration
             continue
 
-        req = requests.post(
-            "https://back.aisha.group/api/v1/tts/post/",
-            data={
-                "transcript": text,
-                "language": "uz",
-                "run_diarization": "false",
-                "model": AUDIO_MODEL
-            },
-            headers={
-                "x-api-key": os.getenv('AISHA_TOKEN'),
-                "X-Channels": "stereo",
-                "X-Quality": "64k",
-                "X-Rate": "16000",
-                "X-Format": "mp3"
-            }
-        )
+        audio_file = os.path.join("./audio", AUDIO_MODEL + "-" + hashlib.md5(text.encode('utf-8')).hexdigest() + ".mp3")
+        if not os.path.exists(audio_file):
+            request_tts(text, audio_file)
 
-        audio_path = req.json()["audio_path"]
-        response = requests.get("https://back.aisha.group" + audio_path, stream=True)
+        page.audio = AudioFileClip(audio_file).with_start(offset)
+        offset += page.audio.duration
 
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Save the file locally
-            with open(audio_file, "wb") as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
 
-            print(f"File downloaded and saved as {audio_file}")
+def stub_audio(text):
+    samples = max(1, int(len(text) * STUB_LETTER_TIME * STUB_AUDIO_FPS))
+    return AudioArrayClip(np.zeros((samples, 2)), fps=STUB_AUDIO_FPS)
 
-        page.audio = AudioFileClip(audio_file).with_start(offset)
-        offset += page.audio.duration
 
+def request_tts(text, audio_file):
+    req = requests.post(
+        "https://back.aisha.group/api/v1/tts/post/",
+        data={
+            "transcript": text,
+            "language": "uz",
+            "run_diarization": "false",
+            "model": AUDIO_MODEL
+        },
+        headers={
+            "x-api-key": os.getenv('AISHA_TOKEN'),
+            "X-Channels": "stereo",
+            "X-Quality": "64k",
+            "X-Rate": "16000",
+            "X-Format": "mp3"
+        }
+    )
 
-def render_short(short: ContentShort, bg_image):
-    print(f"Render {short.name} ... ", end="")
-    output_file = os.path.join(args.output_directory, AUDIO_MODEL + " - " + short.name + ".mp4")
-    if os.path.exists(output_file):
-        print("already exists")
-        return
+    audio_path = req.json()["audio_path"]
+    response = requests.get("https://back.aisha.group" + audio_path, stream=True)
 
+    # Check if the request was successful
+    if response.status_code == 200:
+        # Save the file locally, render workers must never see a half written file
+        tmp_file = audio_file + "." + uuid.uuid4().hex + ".tmp"
+        with open(tmp_file, "wb") as file:
+            for chunk in response.iter_content(chunk_size=8192):
+                file.write(chunk)
+
+        os.replace(tmp_file, audio_file)
+
+        print(f"File downloaded and saved as {audio_file}")
+
+
+def compose_short(short: ContentShort, bg_image):
     audio_clips, video_clips = [], []
     offset = duration = SHORT_DELAY
     color_padding = (20, 10)
@@ -495,25 +637,14 @@ def render_short(short: ContentShort, bg_image):
             audio_clips.append(page.audio)
             duration += page.audio.duration
 
-    logo = ImageClip(
-        img="./assets/itboom-uz-logo-white.png",
-        duration=duration + SHORT_DELAY,
-    ).with_position(("center", 50))
+    logo = logo_sprite().with_duration(duration + SHORT_DELAY).with_position(("center", 50))
 
-    footer = TextClip(
-        text=f"{datetime.date.today().year} © itboom.uz",
-        text_align="center",
-        font=ContentText.get_font_path(True, False),
-        font_size=50,
-        color="black",
-        stroke_color="white",
-        stroke_width=3,
-        margin=(50, 50),
-        duration=duration + SHORT_DELAY,
+    footer = footer_sprite(f"{today().year} © itboom.uz").with_duration(
+        duration + SHORT_DELAY
     ).with_position(("center", "bottom"))
 
-    background = ImageClip(bg_image, duration=duration + SHORT_DELAY).with_effects([
-        BgEffect(width=args.width, height=args.height, duration=duration + SHORT_DELAY)
+    background = background_sprite(bg_image).with_duration(duration + SHORT_DELAY).with_effects([
+        BgEffect(width=args.width, height=args.height, duration=duration + SHORT_DELAY, prepared=True)
     ])
 
     for i, clip in enumerate(video_clips):
@@ -522,28 +653,308 @@ def render_short(short: ContentShort, bg_image):
 
     video = CompositeVideoClip([background, logo, footer, *video_clips])
     video.audio = CompositeAudioClip(audio_clips)
-    video.write_videofile(output_file, fps=args.fps, codec='libx264', audio_codec="aac")
+    return video
 
 
-def main():
-    content = parse_markdown(args.markdown_file)
+def render_short(short: ContentShort, bg_image, logger="bar", output_file=None):
+    # the default bar continues this line, a custom logger does not
+    print(f"Render {short.name} ... ", end="" if logger == "bar" else "\n")
+    if output_file is None:
+        output_file = os.path.join(args.output_directory, AUDIO_MODEL + " - " + short.name + ".mp4")
+
+    if os.path.exists(output_file):
+        print("already exists")
+        return output_file
+
+    video = compose_short(short, bg_image)
+    video.write_videofile(output_file, fps=args.fps, codec='libx264', audio_codec="aac", logger=logger)
+
+    return output_file
+
+
+class RenderJob:
+    def __init__(self, short: ContentShort, priority=0):
+        self.id = uuid.uuid4().hex
+        self.name = short.name
+        self.short = short
+        self.priority = priority
+        self.status = "queued"
+        self.progress = 0.0
+        self.fps = 0.0
+        self.output_file = None
+        self.error = None
+        self.__frames_started_at = None
+
+    def start(self):
+        self.status = "running"
+
+    def start_frames(self):
+        self.__frames_started_at = time.monotonic()
+
+    def update(self, frame, total):
+        # TTS and the audio track are written before the first frame, they are not part of the render fps
+        if self.__frames_started_at is None:
+            self.start_frames()
+
+        elapsed = time.monotonic() - self.__frames_started_at
+        if total:
+            self.progress = frame / total
+
+        if elapsed > 0:
+            self.fps = frame / elapsed
+
+    def finish(self, output_file):
+        self.status = "done"
+        self.progress = 1.0
+        self.output_file = output_file
+        self.short = None
+
+    def fail(self, error):
+        self.status = "failed"
+        self.error = str(error)
+        self.short = None
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "priority": self.priority,
+            "status": self.status,
+            "progress": round(self.progress, 4),
+            "fps": round(self.fps, 2),
+            "output_file": self.output_file,
+            "error": self.error,
+        }
+
+
+class RenderJobLogger(ProgressBarLogger):
+    def __init__(self, job: RenderJob):
+        super().__init__()
+        self.job = job
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if bar != "frame_index":
+            return
+
+        if attr == "total":
+            self.job.start_frames()
+        elif attr == "index":
+            self.job.update(value, self.bars[bar]["total"])
+
+
+class RenderServer:
+    def __init__(self, bg_files, workers):
+        self.bg_files = bg_files
+        self.jobs = {}
+        self.queue = queue.PriorityQueue()
+        self.__counter = itertools.count()
+        self.__parse_lock = threading.Lock()
+        self.__jobs_lock = threading.Lock()
+        self.__workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+
+    def start(self):
+        for worker in self.__workers:
+            worker.start()
+
+    def submit(self, source, base_dir, priority=0):
+        # ContentCode writes a temporary source file into the working directory
+        with self.__parse_lock:
+            content = parse_markdown_source(source, base_dir)
+
+        ids = []
+        for short in content.shorts:
+            job = RenderJob(short, priority)
+            with self.__jobs_lock:
+                self.jobs[job.id] = job
+            self.queue.put((-priority, next(self.__counter), job.id))
+            ids.append(job.id)
+
+        return ids
+
+    def get_job(self, job_id):
+        with self.__jobs_lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.__jobs_lock:
+            return list(self.jobs.values())
+
+    def work(self):
+        while True:
+            _, _, job_id = self.queue.get()
+            job = self.get_job(job_id)
+            job.start()
+            try:
+                load_audio(job.short)
+                job.finish(render_short(
+                    job.short,
+                    choose_background(job.short, self.bg_files),
+                    logger=RenderJobLogger(job),
+                    output_file=os.path.join(
+                        args.output_directory, AUDIO_MODEL + " - " + job.short.name + " - " + job.id + ".mp4"
+                    )
+                ))
+            except Exception as e:
+                job.fail(e)
+            finally:
+                self.queue.task_done()
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        render_server: RenderServer = self.server.render_server
+        parts = self.path.strip("/").split("/")
+
+        if parts == ["jobs"]:
+            self.send_json(200, {"jobs": [job.as_dict() for job in render_server.list_jobs()]})
+            return
+
+        job = render_server.get_job(parts[1]) if len(parts) == 2 and parts[0] == "jobs" else None
+        if job is None:
+            self.send_json(404, {"error": "not found"})
+            return
+
+        self.send_json(200, job.as_dict())
+
+    def do_POST(self):
+        render_server: RenderServer = self.server.render_server
+        if self.path.strip("/") != "jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length))
+            ids = render_server.submit(
+                source=data["markdown"],
+                base_dir=data.get("base_dir", "."),
+                priority=int(data.get("priority", 0))
+            )
+        except Exception as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        self.send_json(201, {"jobs": ids})
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float("inf")
+
+    return 10 * np.log10(255.0 ** 2 / mse)
+
+
+def check_golden_frames(content: Content, bg_files):
+    os.makedirs(args.golden_dir, exist_ok=True)
 
+    failed = 0
+    stale = []
+    for i, short in enumerate(content.shorts):
+        load_audio(short)
+        video = compose_short(short, choose_background(short, bg_files))
+
+        for t in args.frames:
+            golden_file = os.path.join(args.golden_dir, f"{i:02d}-{t:.2f}.png")
+            if t >= video.duration:
+                if args.update_golden:
+                    print(f"{golden_file} skipped, {short.name} is only {video.duration:.2f}s long")
+
+                if os.path.exists(golden_file):
+                    stale.append(golden_file)
+                continue
+
+            frame = np.clip(video.get_frame(t), 0, 255).astype(np.uint8)
+
+            if args.update_golden:
+                Image.fromarray(frame).save(golden_file)
+                print(f"{golden_file} updated")
+                continue
+
+            if not os.path.exists(golden_file):
+                print(f"{golden_file} missing")
+                failed += 1
+                continue
+
+            golden = np.asarray(Image.open(golden_file).convert("RGB"))
+            if golden.shape != frame.shape:
+                print(f"{golden_file} size mismatch {frame.shape} != {golden.shape}")
+                failed += 1
+                continue
+
+            value = psnr(frame, golden)
+            ok = value >= args.psnr
+            print(f"{golden_file} PSNR {value:.2f} dB {'ok' if ok else 'FAIL'}")
+            if not ok:
+                failed += 1
+
+    # golden frames of shorts that no longer exist
+    for name in sorted(os.listdir(args.golden_dir)):
+        m = re.fullmatch(GOLDEN_FILE_PATTERN, name)
+        if m and int(m.group(1)) >= len(content.shorts):
+            stale.append(os.path.join(args.golden_dir, name))
+
+    for golden_file in stale:
+        if args.update_golden:
+            os.remove(golden_file)
+            print(f"{golden_file} removed, no matching frame")
+        else:
+            print(f"{golden_file} has no matching frame")
+            failed += 1
+
+    return failed
+
+
+def list_backgrounds():
     p = Path(args.bg_path)
-    bg_files = list(
+    return list(
         sorted([str(f.resolve()) for f in p.iterdir() if f.suffix.lower() in IMAGE_EXTENSIONS and f.is_file()]))
 
+
+def serve(bg_files):
+    render_server = RenderServer(bg_files, args.workers)
+    render_server.start()
+
+    httpd = ThreadingHTTPServer((args.host, args.port), RenderRequestHandler)
+    httpd.render_server = render_server
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+def main():
+    bg_files = list_backgrounds()
+
+    if args.serve:
+        serve(bg_files)
+        return
+
+    content = parse_markdown(args.markdown_file)
+
+    if args.golden_dir is not None:
+        if check_golden_frames(content, bg_files):
+            sys.exit(1)
+        return
+
     for short in content.shorts:
         load_audio(short)
-        render_short(short, random.choice(bg_files))
+        render_short(short, choose_background(short, bg_files))
 
 
 if __name__ == "__main__":
     load_dotenv(".env.production")
 
-    FONT_HEIGHT = ContentText.get_font_max_height()
-    # SPACE_WIDTH = TextClip(
-    #     text=" ",
-    #     font=ContentText.get_font_path(True, False, False),
-    #     font_size=args.font_size
-    # ).size[0]
+    configure()
     main()
@@ -0,0 +1,97 @@
+import datetime
+import shutil
+from pathlib import Path
+
+import pytest
+
+import main
+
+ROOT = Path(__file__).resolve().parent.parent
+GOLDEN_DIR = ROOT / "demo" / "golden"
+
+
+def configure(golden_dir, *argv, date="2025-01-01"):
+    main.configure([
+        "demo/raqamlar.md", "--seed", "0", "--date", date, "--golden-dir", str(golden_dir), *argv
+    ])
+    return main.parse_markdown(main.args.markdown_file)
+
+
+@pytest.fixture(autouse=True)
+def no_external_tools(monkeypatch):
+    monkeypatch.chdir(ROOT)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("golden mode must not call TTS or carbon-now")
+
+    monkeypatch.setattr(main, "request_tts", fail)
+    monkeypatch.setattr(main.subprocess, "run", fail)
+
+
+def test_golden_frames():
+    content = configure(GOLDEN_DIR)
+
+    assert main.check_golden_frames(content, main.list_backgrounds()) == 0
+
+
+def test_clock_is_injectable(monkeypatch):
+    configure(GOLDEN_DIR)
+    assert main.today() == datetime.date(2025, 1, 1)
+
+    # restored by monkeypatch after the test
+    monkeypatch.setattr(main, "clock", main.clock)
+    main.set_clock(lambda: datetime.date(1999, 12, 31))
+    assert main.today() == datetime.date(1999, 12, 31)
+
+
+def test_changed_date_fails():
+    content = configure(GOLDEN_DIR, "--frames", "1", date="2026-01-01")
+
+    assert main.check_golden_frames(content, main.list_backgrounds()) == 2
+
+
+def test_changed_text_fails():
+    configure(GOLDEN_DIR, "--frames", "5")
+    source = (ROOT / "demo" / "raqamlar.md").read_text()
+    content = main.parse_markdown_source(source.replace("kundalik", "kunlik"), "demo")
+
+    assert main.check_golden_frames(content, main.list_backgrounds()) == 1
+
+
+def copy_golden(tmp_path, names):
+    for name, source in names.items():
+        shutil.copy(GOLDEN_DIR / source, tmp_path / name)
+
+
+def test_partial_frames_pass():
+    content = configure(GOLDEN_DIR, "--frames", "1,5")
+
+    assert main.check_golden_frames(content, main.list_backgrounds()) == 0
+
+
+def test_removed_short_fails(tmp_path):
+    copy_golden(tmp_path, {
+        "00-1.00.png": "00-1.00.png",
+        "01-1.00.png": "01-1.00.png",
+        "02-1.00.png": "01-1.00.png",
+        "raqamlar.png": "01-1.00.png",
+    })
+
+    content = configure(tmp_path, "--frames", "1")
+    assert main.check_golden_frames(content, main.list_backgrounds()) == 1
+
+    content = configure(tmp_path, "--frames", "1", "--update-golden")
+    assert main.check_golden_frames(content, main.list_backgrounds()) == 0
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["00-1.00.png", "01-1.00.png", "raqamlar.png"]
+
+
+def test_timestamp_past_end_fails(tmp_path):
+    copy_golden(tmp_path, {
+        "00-1.00.png": "00-1.00.png",
+        "01-1.00.png": "01-1.00.png",
+        "00-100.00.png": "00-1.00.png",
+    })
+
+    content = configure(tmp_path, "--frames", "1,100")
+
+    assert main.check_golden_frames(content, main.list_backgrounds()) == 1
@@ -0,0 +1,202 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+import requests
+
+import main
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DOCUMENT = """# Birinchi
+Birinchi qisqa video matni.
+
+# Ikkinchi
+Ikkinchi qisqa video matni.
+
+# Uchinchi
+Uchinchi qisqa video matni.
+"""
+
+
+class FakeRender:
+    TOTAL_FRAMES = 10
+
+    def __init__(self):
+        self.rendered = []
+        self.halfway = threading.Event()
+        self.proceed = threading.Event()
+
+    def __call__(self, short, bg_image, logger="bar", output_file=None):
+        self.rendered.append(short.name)
+
+        logger(frame_index__total=self.TOTAL_FRAMES)
+        for i in range(self.TOTAL_FRAMES // 2):
+            time.sleep(0.01)
+            logger(frame_index__index=i + 1)
+
+        self.halfway.set()
+        assert self.proceed.wait(10)
+
+        for i in range(self.TOTAL_FRAMES // 2, self.TOTAL_FRAMES):
+            logger(frame_index__index=i + 1)
+
+        return output_file
+
+
+def stub_tts(text, audio_file):
+    raise AssertionError("TTS must not be called from tests")
+
+
+@pytest.fixture
+def http_server():
+    servers = []
+
+    def start(render_server):
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), main.RenderRequestHandler)
+        httpd.render_server = render_server
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    yield start
+
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def fake_render(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    main.configure(["--serve", "--workers", "1"])
+
+    fake = FakeRender()
+    monkeypatch.setattr(main, "request_tts", stub_tts)
+    monkeypatch.setattr(main, "load_audio", lambda short: None)
+    monkeypatch.setattr(main, "render_short", fake)
+    return fake
+
+
+@pytest.fixture
+def server(fake_render, http_server):
+    render_server = main.RenderServer(["background.jpg"], workers=1)
+
+    yield render_server, http_server(render_server)
+
+    fake_render.proceed.set()
+
+
+def submit(url, markdown, priority=0):
+    response = requests.post(url + "/jobs", json={"markdown": markdown, "priority": priority})
+    assert response.status_code == 201
+    return response.json()["jobs"]
+
+
+def get_job(url, job_id):
+    response = requests.get(url + "/jobs/" + job_id)
+    assert response.status_code == 200
+    return response.json()
+
+
+def wait_for(url, job_id, status, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        job = get_job(url, job_id)
+        if job["status"] == status:
+            return job
+        time.sleep(0.01)
+
+    raise AssertionError(f"job {job_id} never became {status}")
+
+
+def test_one_job_per_short(server):
+    render_server, url = server
+
+    ids = submit(url, DOCUMENT)
+
+    assert len(ids) == 3
+    assert len(set(ids)) == 3
+    jobs = requests.get(url + "/jobs").json()["jobs"]
+    assert [job["name"] for job in jobs] == ["Birinchi", "Ikkinchi", "Uchinchi"]
+    assert all(job["status"] == "queued" for job in jobs)
+
+
+def test_higher_priority_first(server, fake_render):
+    render_server, url = server
+    fake_render.proceed.set()
+
+    low = submit(url, "# Past\nPast ustuvorlik.", priority=0)
+    high = submit(url, "# Yuqori\nYuqori ustuvorlik.", priority=5)
+    render_server.start()
+
+    wait_for(url, low[0], "done")
+    wait_for(url, high[0], "done")
+    assert fake_render.rendered == ["Yuqori", "Past"]
+
+
+def test_job_progress(server, fake_render):
+    render_server, url = server
+
+    job_id = submit(url, "# Holat\nHolat matni.")[0]
+    assert get_job(url, job_id)["status"] == "queued"
+
+    render_server.start()
+    assert fake_render.halfway.wait(10)
+
+    job = get_job(url, job_id)
+    assert job["status"] == "running"
+    assert job["progress"] == 0.5
+    assert job["fps"] > 0
+
+    fake_render.proceed.set()
+    job = wait_for(url, job_id, "done")
+    assert job["progress"] == 1.0
+    assert job["fps"] > 0
+    assert job["output_file"].endswith(job_id + ".mp4")
+    assert job["error"] is None
+
+
+def test_unknown_job(server):
+    render_server, url = server
+
+    assert requests.get(url + "/jobs/missing").status_code == 404
+    assert requests.post(url + "/jobs", json={}).status_code == 400
+
+
+def test_render_with_stub_audio(monkeypatch, tmp_path, http_server):
+    monkeypatch.chdir(ROOT)
+    main.configure([
+        "--serve", "--stub-audio", "--workers", "2",
+        "--width", "270", "--height", "480", "--fps", "10", "--font-size", "25", "--text-padding", "10",
+        "-o", str(tmp_path)
+    ])
+    monkeypatch.setattr(main, "request_tts", stub_tts)
+
+    updates = []
+    update = main.RenderJob.update
+
+    def record_update(job, frame, total):
+        updates.append((job.id, frame, total))
+        update(job, frame, total)
+
+    monkeypatch.setattr(main.RenderJob, "update", record_update)
+
+    render_server = main.RenderServer(main.list_backgrounds(), workers=2)
+    url = http_server(render_server)
+    render_server.start()
+
+    ids = submit(url, "# Bir\nBirinchi matn.\n\n# Ikki\nIkkinchi matn.")
+    assert len(ids) == 2
+
+    for job_id in ids:
+        job = wait_for(url, job_id, "done", timeout=120)
+        assert job["error"] is None
+        assert job["fps"] > 0
+        assert Path(job["output_file"]).parent == tmp_path
+        assert Path(job["output_file"]).stat().st_size > 0
+
+        frames = [(frame, total) for update_id, frame, total in updates if update_id == job_id]
+        assert frames
+        assert frames[-1][0] == frames[-1][1]